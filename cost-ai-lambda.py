@@ -1,5 +1,6 @@
 import boto3
 import json
+from array import array
 from datetime import datetime, timedelta
 
 # Initialize AWS clients
@@ -9,6 +10,18 @@ sns_client = boto3.client('sns')
 # SNS Topic ARN (Replace with your actual ARN)
 SNS_TOPIC_ARN = "arn:aws:sns:us-east-1:195275662048:FastAPIAlerts"
 
+# Hourly ingestion settings (HOURLY granularity must be enabled in Cost Explorer and covers the last 14 days)
+HOURLY_LOOKBACK_HOURS = 24
+HOURLY_METRICS = ['BLENDED_COST', 'UNBLENDED_COST', 'NET_UNBLENDED_COST', 'AMORTIZED_COST']
+# Cost Explorer allows at most two GroupBy keys per query, so each pair is its own rollup
+HOURLY_GROUPINGS = [('SERVICE', 'USAGE_TYPE'), ('LINKED_ACCOUNT', 'REGION')]
+METRIC_LABELS = {
+    'NET_UNBLENDED_COST': 'Original Cost (Before Credits)',
+    'UNBLENDED_COST': 'Cost After Credits',
+    'BLENDED_COST': 'Blended Cost',
+    'AMORTIZED_COST': 'Amortized Cost',
+}
+
 def get_daily_cost():
     ce_client = boto3.client('ce')
 
@@ -49,6 +62,153 @@ def get_daily_cost():
 
 
 
+class CostRollup:
+    """Columnar store of Cost Explorer groups with dictionary-encoded dimension keys."""
+
+    def __init__(self, dimensions, metrics=HOURLY_METRICS):
+        self.dimensions = ('HOUR',) + tuple(dimensions)
+        self.metrics = tuple(metrics)
+        self.dictionaries = {dimension: [] for dimension in self.dimensions}  # code -> value
+        self.codes = {dimension: {} for dimension in self.dimensions}  # value -> code
+        self.postings = {dimension: [] for dimension in self.dimensions}  # code -> row ids
+        self.keys = {dimension: array('I') for dimension in self.dimensions}
+        self.values = {metric: array('d') for metric in self.metrics}
+
+    def __len__(self):
+        return len(self.values[self.metrics[0]])
+
+    def encode(self, dimension, value):
+        codes = self.codes[dimension]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.dictionaries[dimension])
+            self.dictionaries[dimension].append(value)
+            self.postings[dimension].append(array('I'))
+        return code
+
+    def append(self, key_values, metric_values):
+        row = len(self)
+        for dimension, value in zip(self.dimensions, key_values):
+            code = self.encode(dimension, value)
+            self.keys[dimension].append(code)
+            self.postings[dimension][code].append(row)
+        for metric, value in zip(self.metrics, metric_values):
+            self.values[metric].append(value)
+
+    def rows(self, **filters):
+        """Returns row ids matching every DIMENSION=value filter, scanning the shortest posting list."""
+        if not filters:
+            return range(len(self))
+
+        encoded = []
+        for dimension, value in filters.items():
+            code = self.codes[dimension].get(value)
+            if code is None:
+                return []
+            encoded.append((dimension, code))
+        encoded.sort(key=lambda item: len(self.postings[item[0]][item[1]]))
+
+        (dimension, code), rest = encoded[0], encoded[1:]
+        rest = [(self.keys[other], other_code) for other, other_code in rest]
+        return [row for row in self.postings[dimension][code] if all(keys[row] == c for keys, c in rest)]
+
+    def aggregate(self, by, metric='UNBLENDED_COST', **filters):
+        """Sums a metric per value of `by` over the rows matching the filters."""
+        keys, values = self.keys[by], self.values[metric]
+        totals = {}
+        for row in self.rows(**filters):
+            code = keys[row]
+            totals[code] = totals.get(code, 0.0) + values[row]
+        names = self.dictionaries[by]
+        return {names[code]: total for code, total in totals.items()}
+
+
+def get_hourly_cost(hours=HOURLY_LOOKBACK_HOURS):
+    """Fetches hourly costs for every grouping in HOURLY_GROUPINGS into CostRollups, following pagination."""
+
+    end_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    start_time = end_time - timedelta(hours=hours)
+
+    try:
+        rollups = {}
+        for dimensions in HOURLY_GROUPINGS:
+            rollup = CostRollup(dimensions)
+            request = {
+                'TimePeriod': {'Start': start_time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'End': end_time.strftime('%Y-%m-%dT%H:%M:%SZ')},
+                'Granularity': 'HOURLY',
+                'Metrics': HOURLY_METRICS,
+                'GroupBy': [{'Type': 'DIMENSION', 'Key': key} for key in dimensions]
+            }
+            while True:
+                response = ce_client.get_cost_and_usage(**request)
+                for result in response.get('ResultsByTime', []):
+                    hour = result['TimePeriod']['Start']
+                    for group in result.get('Groups', []):
+                        try:
+                            amounts = [float(group['Metrics'][metric]['Amount']) for metric in HOURLY_METRICS]
+                        except (KeyError, ValueError, TypeError) as e:
+                            return {"error": f"Data processing error: {str(e)}"}
+                        rollup.append([hour] + group['Keys'], amounts)
+
+                next_token = response.get('NextPageToken')
+                if not next_token:
+                    break
+                request['NextPageToken'] = next_token
+            rollups[dimensions] = rollup
+
+        return rollups
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def find_cost_spike(rollup, service, top=3):
+    """Returns the most expensive hour for a service and the usage types that drove it."""
+
+    hourly = rollup.aggregate('HOUR', SERVICE=service)
+    if not hourly:
+        return None, 0.0, []
+    hour = max(hourly, key=hourly.get)
+    drivers = rollup.aggregate('USAGE_TYPE', SERVICE=service, HOUR=hour)
+    return hour, hourly[hour], sorted(drivers.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def render_hourly_report(rollups, hours=HOURLY_LOOKBACK_HOURS):
+    """Renders the hourly report from the rollup columns in a single pass per rollup."""
+
+    usage = rollups[('SERVICE', 'USAGE_TYPE')]
+    services = usage.dictionaries['SERVICE']
+    totals = {metric: [0.0] * len(services) for metric in HOURLY_METRICS}
+    columns = [(totals[metric], usage.values[metric]) for metric in HOURLY_METRICS]
+    for row, service in enumerate(usage.keys['SERVICE']):
+        for total, values in columns:
+            total[service] += values[row]
+
+    lines = [f"AWS Hourly Cost Report (last {hours} hours):", ""]
+    cost_after_credits = totals['UNBLENDED_COST']
+    for code in sorted(range(len(services)), key=lambda code: cost_after_credits[code], reverse=True):
+        lines.append(f"- {services[code]}:")
+        for metric in ('NET_UNBLENDED_COST', 'UNBLENDED_COST', 'BLENDED_COST', 'AMORTIZED_COST'):
+            lines.append(f"  * {METRIC_LABELS[metric]}: ${totals[metric][code]:.2f}")
+
+        hour, peak, drivers = find_cost_spike(usage, services[code])
+        if peak > 0:
+            breakdown = ", ".join(f"{usage_type} (${cost:.2f})" for usage_type, cost in drivers)
+            lines.append(f"  * Peak Hour: {hour} (${peak:.2f}) driven by {breakdown}")
+        lines.append("")
+
+    accounts = rollups[('LINKED_ACCOUNT', 'REGION')]
+    account_names, region_names = accounts.dictionaries['LINKED_ACCOUNT'], accounts.dictionaries['REGION']
+    pairs = {}
+    for account, region, cost in zip(accounts.keys['LINKED_ACCOUNT'], accounts.keys['REGION'], accounts.values['UNBLENDED_COST']):
+        pairs[(account, region)] = pairs.get((account, region), 0.0) + cost
+
+    lines.append("Cost After Credits by Account and Region:")
+    for (account, region), cost in sorted(pairs.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"- {account_names[account]} / {region_names[region] or 'global'}: ${cost:.2f}")
+
+    return "\n".join(lines)
+
+
 def suggest_cost_optimizations(cost_report):
     """Analyzes cost report and provides cost-saving suggestions."""
     
@@ -83,6 +243,9 @@ def lambda_handler(event, context):
     """Main Lambda function entry point."""
     
     try:
+        if event.get("granularity") == "HOURLY":
+            return send_hourly_cost_report(event.get("hours", HOURLY_LOOKBACK_HOURS))
+
         # Fetch daily cost report
         cost_report = get_daily_cost()
 
@@ -126,3 +289,24 @@ def lambda_handler(event, context):
             "body": json.dumps({"error": str(e)})
         }
 
+
+def send_hourly_cost_report(hours):
+    """Builds and sends the hourly report from a single ingestion of Cost Explorer data."""
+
+    rollups = get_hourly_cost(hours)
+    if "error" in rollups:
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": rollups["error"]})
+        }
+
+    report_message = render_hourly_report(rollups, hours)
+    sns_response = send_sns_email("Hourly AWS Cost Report", report_message)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "Hourly cost report sent successfully!",
+            "snsResponse": sns_response
+        })
+    }
@@ -1,6 +1,8 @@
 import json
 import psycopg2
 import os
+import time
+import threading
 import pymongo
 import numpy as np
 from datetime import datetime
@@ -9,6 +11,19 @@ from botocore.exceptions import ClientError
 import boto3
 
 SECRET_MANAGER = boto3.client("secretsmanager")
+FORECAST_TTL_SECONDS = int(os.environ.get("FORECAST_TTL_SECONDS", "60"))
+RECORD_BATCH_SIZE = int(os.environ.get("RECORD_BATCH_SIZE", "50"))
+RECORD_FLUSH_SECONDS = float(os.environ.get("RECORD_FLUSH_SECONDS", "5"))
+MAX_PENDING_RECORDS = int(os.environ.get("MAX_PENDING_RECORDS", "5000"))
+FORECAST_RETRY_SECONDS = 5
+
+# Module-level state survives warm invocations of the same Lambda container
+pg_credentials = None
+cached_forecast = (None, 0.0)  # (prediction, monotonic expiry), replaced atomically
+forecast_lock = threading.Lock()
+pending_records = []
+records_lock = threading.Lock()
+next_flush_at = 0.0  # monotonic time before which no flush is retried after a connection failure
 
 
 def get_pg_credentials():
@@ -37,7 +52,7 @@ def predict_response_time(times):
     model = LinearRegression().fit(X, y)
     return model.predict([[len(times)]])[0]
 
-def store_prediction(pg_creds, user_name, prediction):
+def store_predictions(pg_creds, records):
     conn = psycopg2.connect(
         host=pg_creds["host"],
         port=pg_creds["port"],
@@ -47,33 +62,126 @@ def store_prediction(pg_creds, user_name, prediction):
     )
     cursor = conn.cursor()
 
-    now = datetime.utcnow()
-    print(now)
     insert_query = """
         INSERT INTO predict_response_times (user_name, timestamp, response_time)
         VALUES (%s, %s, %s)
     """
-    cursor.execute(insert_query, (user_name, now, float(prediction)))
+    cursor.executemany(insert_query, records)
     conn.commit()
 
     cursor.close()
     conn.close()
 
+def get_cached_pg_credentials():
+    global pg_credentials
+    if pg_credentials is None:
+        pg_credentials = get_pg_credentials()
+    return pg_credentials
+
+def invalidate_pg_credentials(error):
+    # A connect or auth failure usually means the secret was rotated; re-fetch it next time
+    global pg_credentials
+    if isinstance(error, psycopg2.OperationalError):
+        pg_credentials = None
+
+def get_forecast():
+    global cached_forecast
+    prediction, expires_at = cached_forecast
+    if time.monotonic() < expires_at:
+        return prediction
+
+    # Only one caller refits; the others wait on the lock and then read its result
+    with forecast_lock:
+        prediction, expires_at = cached_forecast
+        if time.monotonic() < expires_at:
+            return prediction
+
+        try:
+            prediction = float(predict_response_time(fetch_response_times(get_cached_pg_credentials())))
+        except Exception as e:
+            invalidate_pg_credentials(e)
+            if prediction is None:
+                raise
+            print(f"Error refreshing forecast, serving stale value: {e}")
+            cached_forecast = (prediction, time.monotonic() + FORECAST_RETRY_SECONDS)
+            return prediction
+
+        cached_forecast = (prediction, time.monotonic() + FORECAST_TTL_SECONDS)
+        return prediction
+
+def trim_pending_records():
+    # Called with records_lock held; drops the oldest rows when Postgres stays unreachable
+    overflow = len(pending_records) - MAX_PENDING_RECORDS
+    if overflow > 0:
+        del pending_records[:overflow]
+        print(f"Dropped {overflow} oldest prediction records, queue is capped at {MAX_PENDING_RECORDS}")
+
+def record_request(user_name, prediction):
+    # Lambda freezes background threads once the handler returns, so the invocation that
+    # fills the batch (or finds the oldest row stale) flushes it; the rest skip Postgres
+    now = datetime.utcnow()
+    with records_lock:
+        pending_records.append((user_name, now, prediction))
+        trim_pending_records()
+        flush_due = time.monotonic() >= next_flush_at and (
+            len(pending_records) >= RECORD_BATCH_SIZE
+            or (now - pending_records[0][1]).total_seconds() >= RECORD_FLUSH_SECONDS
+        )
+    if flush_due:
+        flush_records()
+
+def requeue_records(records):
+    # Postgres is unreachable; keep the rows and hold off so each request does not retry the connect
+    global next_flush_at
+    with records_lock:
+        next_flush_at = time.monotonic() + RECORD_FLUSH_SECONDS
+        pending_records[:0] = records
+        trim_pending_records()
+
+def flush_records():
+    with records_lock:
+        batch = pending_records[:]
+        pending_records.clear()
+    if not batch:
+        return
+
+    try:
+        store_predictions(get_cached_pg_credentials(), batch)
+        return
+    except psycopg2.OperationalError as e:
+        # Connection or auth problem: keep the rows for the next flush
+        print(f"Error storing predictions: {e}")
+        invalidate_pg_credentials(e)
+        requeue_records(batch)
+        return
+    except Exception as e:
+        print(f"Error storing prediction batch, retrying rows one at a time: {e}")
+
+    # A row the table rejects (e.g. a user name too long for the column) must not block the others
+    for index, record in enumerate(batch):
+        try:
+            store_predictions(get_cached_pg_credentials(), [record])
+        except psycopg2.OperationalError as e:
+            print(f"Error storing predictions: {e}")
+            invalidate_pg_credentials(e)
+            requeue_records(batch[index:])
+            return
+        except Exception as e:
+            print(f"Dropping prediction record for {record[0]}: {e}")
+
 
 def lambda_handler(event, context):
 
-    pg_creds = get_pg_credentials()
     user_name = event.get("user", "sahil@nagarro.com")
 
-    response_times = fetch_response_times(pg_creds)
-    predicted = predict_response_time(response_times)
-    store_prediction(pg_creds, user_name,predicted)
+    predicted = get_forecast()
+    record_request(user_name, predicted)
     print(predicted)
 
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "message": "Prediction stored successfully",
+            "message": "Prediction recorded successfully",
             "predicted_response_time": predicted
         })
     }
@@ -1,6 +1,16 @@
 import os
+import re
 import json
+import time
+import zlib
+import base64
+import codecs
+import random
+import threading
 import boto3
+from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
@@ -8,14 +18,40 @@ from langchain_aws import ChatBedrock
 
 # ==== Environment Variables ====
 REGION = "us-east-1"
-FASTAPI_INSTANCE_ID = os.environ["FASTAPI_INSTANCE_ID"]
-DB_INSTANCE_ID = os.environ["DB_INSTANCE_ID"]
-LOG_GROUP = os.environ["LOG_GROUP"]
+FASTAPI_INSTANCE_ID = os.environ.get("FASTAPI_INSTANCE_ID")
+DB_INSTANCE_ID = os.environ.get("DB_INSTANCE_ID")
+LOG_GROUP = os.environ.get("LOG_GROUP")
 SNS_TOPIC = os.environ["SNS_TOPIC"]
 FASTAPI_SERVICE_NAME = "fastapi.service"
 DB_SERVICE_NAME = "db.service"
 PORT_TO_FREE = "8000"
 
+# ==== Fleet Mode Settings ====
+# JSON list of services, e.g.
+# [{"name": "datatrove-api", "group": "datatrove", "log_groups": ["/datatrove/fastapi"],
+#   "instances": {"fastapi-instance": "i-0abc...", "db-instance": "i-0def..."}}]
+SERVICE_REGISTRY = json.loads(os.environ.get("SERVICE_REGISTRY", "[]"))
+FLEET_FETCH_WORKERS = int(os.environ.get("FLEET_FETCH_WORKERS", "16"))
+BEDROCK_MAX_CONCURRENCY = int(os.environ.get("BEDROCK_MAX_CONCURRENCY", "4"))
+BEDROCK_REQUESTS_PER_SECOND = float(os.environ.get("BEDROCK_REQUESTS_PER_SECOND", "2"))
+LOGS_REQUESTS_PER_SECOND = float(os.environ.get("LOGS_REQUESTS_PER_SECOND", "5"))
+MAX_PROMPT_CHARS = int(os.environ.get("MAX_PROMPT_CHARS", "60000"))
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", "15000"))
+MAX_RETRIES = 6
+THROTTLE_CODES = ("ThrottlingException", "Throttling", "TooManyRequestsException", "LimitExceededException")
+
+# ==== Push Ingestion Settings ====
+WINDOW_SECONDS = int(os.environ.get("WINDOW_SECONDS", "120"))
+MAX_WINDOW_EVENTS = int(os.environ.get("MAX_WINDOW_EVENTS", "5000"))
+MIN_WINDOW_EVENTS = int(os.environ.get("MIN_WINDOW_EVENTS", "5"))
+ERROR_RATE_THRESHOLD = float(os.environ.get("ERROR_RATE_THRESHOLD", "0.2"))
+SEVERITY_THRESHOLD = os.environ.get("SEVERITY_THRESHOLD", "CRITICAL")
+ANALYSIS_COOLDOWN_SECONDS = int(os.environ.get("ANALYSIS_COOLDOWN_SECONDS", "300"))
+DECODE_CHUNK_SIZE = 64 * 1024
+SEVERITY_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40, "CRITICAL": 50, "FATAL": 50}
+SEVERITY_PATTERN = re.compile(r"\b(DEBUG|INFO|WARN|WARNING|ERROR|CRITICAL|FATAL)\b")
+SERVER_ERROR_PATTERN = re.compile(r'HTTP/[\d.]+" 5\d\d')
+
 # ==== AWS Clients ====
 ssm = boto3.client("ssm", region_name=REGION)
 logs_client = boto3.client("logs", region_name=REGION)
@@ -52,6 +88,43 @@ Logs:
 <|eot_id|>
 """
 
+FLEET_PROMPT_TEMPLATE = """<|begin_of_text|><|start_header_id|>user<|end_header_id|>
+You are an AI Root Cause Analyzer and Auto-Fix Agent.
+
+The logs below come from several related services. Each service's logs start with a line `=== service: <name> ===`.
+
+1. For every service that shows a real problem, analyze its logs and describe the root cause.
+2. Identify the impacted component (e.g. FastAPI, Database, OS, Nginx, Disk Space, Network, OS).
+3. Suggest structured fixes as a JSON array with one object per affected service, using the following schema:
+
+[
+  {{
+    "service_name": "...",
+    "issue": "...",
+    "component": "...",
+    "fix": {{
+      "action": "...",
+      "target": "...",
+      "service": "...",
+      "package": "...",
+      "port": ...,
+      "directory": "..."
+    }}
+  }}
+]
+
+Return [] if none of the services has a problem.
+
+Instructions:
+- Ignore routine 404 logs like: `X.X.X.X:PORT - "GET / HTTP/1.1" 404`
+- Ignore logs from the `/sse` route
+- Do not include these in the analysis or fix suggestions
+
+Logs:
+{log_text}
+<|eot_id|>
+"""
+
 
 def initialize_llm():
     return ChatBedrock(
@@ -68,16 +141,71 @@ def initialize_llm():
 llm_prompt = PromptTemplate.from_template(PROMPT_TEMPLATE)
 llm = initialize_llm()
 llm_chain = LLMChain(prompt=llm_prompt, llm=llm)
+fleet_llm_chain = LLMChain(prompt=PromptTemplate.from_template(FLEET_PROMPT_TEMPLATE), llm=llm)
+
+
+# ==== Rate Limiting ====
+class TokenBucket:
+    """Thread-safe token bucket that halves its rate on throttling and recovers on success."""
+
+    def __init__(self, rate, min_rate=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=float("inf")):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+# Shared across warm invocations so the learned Bedrock and CloudWatch Logs rates are kept between runs
+bedrock_limiter = threading.BoundedSemaphore(BEDROCK_MAX_CONCURRENCY)
+bedrock_bucket = TokenBucket(BEDROCK_REQUESTS_PER_SECOND)
+logs_bucket = TokenBucket(LOGS_REQUESTS_PER_SECOND)
+
+# ==== Sliding Windows ====
+# (log_group, log_stream) -> deque of (timestamp_ms, severity, message), kept across warm invocations
+stream_windows = {}
+last_analysis = {}
 
 # ==== Lambda Handler ====
 def lambda_handler(event, context):
     try:
         log_group = LOG_GROUP
+        if not log_group:
+            print("LOG_GROUP is not set.")
+            return {"status": "error", "details": "LOG_GROUP environment variable is not set"}
+
         minutes = event.get("time_range_minutes", 5)
         end_time = int(datetime.now().timestamp() * 1000)
         start_time = int((datetime.now() - timedelta(minutes=minutes)).timestamp() * 1000)
+        deadline = get_deadline(context)
+        # Leave at least half of the remaining time for the LLM call
+        fetch_deadline = time.monotonic() + (deadline - time.monotonic()) / 2
 
-        logs = fetch_logs(log_group, start_time, end_time)
+        logs = fetch_logs(log_group, start_time, end_time, fetch_deadline)
         if not logs:
             print("No logs found.")
             return {"status": "no_logs_found"}
@@ -102,21 +230,442 @@ def lambda_handler(event, context):
         return {"status": "error", "details": str(e)}
 
 
+# ==== Fleet Lambda Handler ====
+def fleet_lambda_handler(event, context):
+    try:
+        services = event.get("services", SERVICE_REGISTRY)
+        if not services:
+            print("No services configured.")
+            return {"status": "no_services_configured"}
+
+        minutes = event.get("time_range_minutes", 5)
+        end_time = int(datetime.now().timestamp() * 1000)
+        start_time = int((datetime.now() - timedelta(minutes=minutes)).timestamp() * 1000)
+        deadline = get_deadline(context)
+        # Leave at least half of the remaining time for the LLM calls
+        fetch_deadline = time.monotonic() + (deadline - time.monotonic()) / 2
+
+        targets, failures = fetch_fleet_logs(services, start_time, end_time, fetch_deadline)
+        if not targets:
+            print("No logs found.")
+            return {"status": "no_logs_found", "results": failures}
+
+        batches = pack_targets(targets)
+        print(f"Logs fetched for {len(targets)} services. Sending {len(batches)} prompts to LLM...")
+
+        with ThreadPoolExecutor(max_workers=BEDROCK_MAX_CONCURRENCY) as pool:
+            results = list(pool.map(lambda batch: analyze_batch(batch, deadline), batches))
+
+        return {"status": "success", "results": failures + results}
+
+    except Exception as e:
+        print(f"Unhandled error: {e}")
+        return {"status": "error", "details": str(e)}
+
+
+# ==== Subscription Lambda Handler ====
+# Receives CloudWatch Logs subscription events ({"awslogs": {"data": ...}}) or Kinesis
+# records carrying the same gzip+base64 payload, and only calls the LLM when a stream's
+# sliding window crosses the error-rate or severity threshold.
+#
+# Windows and cooldowns live in this container's memory, so thresholds are evaluated per
+# container. A stream whose batches are spread over several concurrent containers has its
+# error rate understated and can be analysed more than once per cooldown. Deploy this
+# handler with reserved concurrency 1, or behind a one-shard Kinesis stream with a
+# parallelization factor of 1, so every batch of a stream reaches the same container.
+def subscription_handler(event, context):
+    try:
+        deadline = get_deadline(context)
+        evict_idle_windows()
+        touched = set()
+        for data in iter_subscription_payloads(event):
+            for header, log_event in iter_log_events(iter_decoded_chunks(data)):
+                if header.get("messageType") == "CONTROL_MESSAGE":
+                    continue
+                key = (header.get("logGroup"), header.get("logStream"))
+                record_event(key, log_event)
+                touched.add(key)
+
+        targets = collect_tripped_targets(touched)
+        if not targets:
+            return {"status": "below_threshold", "streams": len(touched)}
+
+        batches = pack_targets(targets)
+        print(f"Thresholds tripped for {len(targets)} services. Sending {len(batches)} prompts to LLM...")
+
+        with ThreadPoolExecutor(max_workers=BEDROCK_MAX_CONCURRENCY) as pool:
+            results = list(pool.map(lambda batch: analyze_batch(batch, deadline), batches))
+
+        for batch, result in zip(batches, results):
+            if result["status"] == "analyzed":
+                mark_streams_analysed(batch)
+
+        return {"status": "success", "results": results}
+
+    except Exception as e:
+        print(f"Unhandled error: {e}")
+        return {"status": "error", "details": str(e)}
+
+
 # ==== Helper Functions ====
 
-def fetch_logs(log_group_name, start_time, end_time):
+def is_throttled(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLE_CODES
+    # langchain wraps Bedrock client errors, so fall back to the message text
+    return any(code in str(error) for code in THROTTLE_CODES)
+
+def call_with_backoff(fn, deadline=float("inf"), bucket=None):
+    for attempt in range(MAX_RETRIES + 1):
+        if bucket and not bucket.acquire(deadline):
+            raise TimeoutError("Rate limiter wait would exceed the Lambda deadline")
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_throttled(e) or attempt == MAX_RETRIES:
+                raise
+            if bucket:
+                bucket.throttled()
+            delay = random.uniform(0, min(20, 0.5 * 2 ** attempt))
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError("Backoff would exceed the Lambda deadline") from e
+            print(f"Throttled, retrying in {delay:.2f}s: {e}")
+            time.sleep(delay)
+            continue
+        if bucket:
+            bucket.succeeded()
+        return result
+
+def get_deadline(context):
+    get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining is None:
+        return float("inf")
+    return time.monotonic() + (get_remaining() - DEADLINE_MARGIN_MS) / 1000
+
+def fetch_logs(log_group_name, start_time, end_time, deadline=float("inf")):
     try:
-        response = logs_client.filter_log_events(
-            logGroupName=log_group_name,
-            startTime=start_time,
-            endTime=end_time,
-            limit=1000
-        )
-        return response.get("events", [])
+        events, complete = fetch_log_tail(log_group_name, start_time, end_time, deadline)
+        return events
     except Exception as e:
         print(f"Error fetching logs: {e}")
         return []
 
+def fetch_log_tail(log_group_name, start_time, end_time, deadline=float("inf"), max_chars=MAX_PROMPT_CHARS):
+    # filter_log_events pages oldest first and may return empty pages that still carry a
+    # nextToken, so follow every page and keep only the newest max_chars of messages.
+    # Returns (events, complete); complete is False when the deadline stopped paging early,
+    # in which case the newest events of the window are missing.
+    request = {
+        "logGroupName": log_group_name,
+        "startTime": start_time,
+        "endTime": end_time,
+        "limit": 10000
+    }
+    events, size = deque(), 0
+    while True:
+        try:
+            response = call_with_backoff(lambda: logs_client.filter_log_events(**request), deadline, logs_bucket)
+        except TimeoutError:
+            if "nextToken" not in request:
+                raise
+            print(f"Deadline reached while paging {log_group_name}; the newest events were not fetched")
+            return list(events), False
+
+        for entry in response.get("events", []):
+            events.append(entry)
+            size += len(entry["message"]) + 1
+            while size > max_chars and len(events) > 1:
+                size -= len(events.popleft()["message"]) + 1
+
+        next_token = response.get("nextToken")
+        if not next_token:
+            return list(events), True
+        if time.monotonic() >= deadline:
+            print(f"Deadline reached while paging {log_group_name}; the newest events were not fetched")
+            return list(events), False
+        request["nextToken"] = next_token
+
+def fetch_fleet_logs(services, start_time, end_time, deadline):
+    def fetch(job):
+        try:
+            events, complete = fetch_log_tail(job[1], start_time, end_time, deadline)
+        except Exception as e:
+            print(f"Error fetching logs for {job[1]}: {e}")
+            return [], {"status": "fetch_error", "details": str(e)}
+        if not complete:
+            return events, {"status": "partial_fetch", "details": "Fetch deadline reached before the newest events; only older pages were analysed"}
+        return events, None
+
+    jobs = [(service, log_group) for service in services for log_group in service.get("log_groups", [])]
+    with ThreadPoolExecutor(max_workers=FLEET_FETCH_WORKERS) as pool:
+        fetched = list(pool.map(fetch, jobs))
+
+    events_by_service, failures = {}, []
+    for (service, log_group), (events, issue) in zip(jobs, fetched):
+        events_by_service.setdefault(service["name"], []).extend(events)
+        if issue is not None:
+            failures.append({"services": [service["name"]], "log_group": log_group, **issue})
+
+    targets = []
+    for service in services:
+        events = sorted(events_by_service.get(service["name"], []), key=lambda entry: entry["timestamp"])
+        if events:
+            log_text = "\n".join(entry["message"] for entry in events)
+            targets.append({"service": service, "log_text": truncate_logs(log_text)})
+    return targets, failures
+
+def truncate_logs(log_text, limit=MAX_PROMPT_CHARS):
+    # Keep the most recent lines when a single service alone exceeds the prompt budget
+    if len(log_text) <= limit:
+        return log_text
+    tail = log_text[-limit:]
+    return tail[tail.find("\n") + 1:]
+
+def pack_targets(targets):
+    groups = {}
+    for target in targets:
+        service = target["service"]
+        groups.setdefault(service.get("group", service["name"]), []).append(target)
+
+    batches = []
+    for members in groups.values():
+        batch, size = [], 0
+        for target in members:
+            section_size = len(target["log_text"]) + len(target["service"]["name"]) + 20
+            if batch and size + section_size > MAX_PROMPT_CHARS:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(target)
+            size += section_size
+        batches.append(batch)
+    return batches
+
+def analyze_batch(batch, deadline):
+    names = [target["service"]["name"] for target in batch]
+    if time.monotonic() >= deadline:
+        print(f"Skipping {names}: Lambda deadline reached")
+        return {"services": names, "status": "skipped_deadline"}
+
+    try:
+        if len(batch) == 1:
+            chain, log_text = llm_chain, batch[0]["log_text"]
+        else:
+            chain = fleet_llm_chain
+            log_text = "\n".join(f"=== service: {target['service']['name']} ===\n{target['log_text']}" for target in batch)
+
+        with bedrock_limiter:
+            llm_response = call_with_backoff(lambda: chain.run(log_text=log_text), deadline, bedrock_bucket)
+        print(f"LLM Output for {names}:", llm_response)
+
+        send_alert(f"AI Root Cause Analysis: {', '.join(names)}"[:100], llm_response)
+
+        fixes = parse_fleet_fixes(llm_response, batch)
+        for fix_target, fix_command in fixes:
+            send_ssm_command(fix_target, fix_command)
+
+        return {"services": names, "status": "analyzed", "fixes": len(fixes)}
+
+    except Exception as e:
+        print(f"Error analyzing {names}: {e}")
+        return {"services": names, "status": "error", "details": str(e)}
+
+def parse_fleet_fixes(llm_output, batch):
+    try:
+        data = json.loads(llm_output)
+    except Exception as e:
+        print("Failed to parse LLM output:", e)
+        return []
+
+    if isinstance(data, dict):
+        data = [data]
+    services = {target["service"]["name"]: target["service"] for target in batch}
+
+    fixes = []
+    for item in data:
+        name = item.get("service_name") or (batch[0]["service"]["name"] if len(batch) == 1 else None)
+        service = services.get(name)
+        if service is None:
+            continue
+        fix_target, fix_command = prepare_fix_command(item.get("fix", {}), service.get("instances", {}))
+        if fix_target and fix_command:
+            fixes.append((fix_target, fix_command))
+    return fixes
+
+def iter_subscription_payloads(event):
+    if "awslogs" in event:
+        yield event["awslogs"]["data"]
+    for record in event.get("Records", []):
+        if "kinesis" in record:
+            yield record["kinesis"]["data"]
+
+def iter_decoded_chunks(data, chunk_size=DECODE_CHUNK_SIZE):
+    # base64 -> gzip -> utf-8 one slice at a time; slices are multiples of 4 so each decodes alone
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunk_size -= chunk_size % 4
+    for offset in range(0, len(data), chunk_size):
+        yield text_decoder.decode(decompressor.decompress(base64.b64decode(data[offset:offset + chunk_size])))
+    yield text_decoder.decode(decompressor.flush(), final=True)
+
+def iter_log_events(chunks):
+    # Walks the top-level payload object incrementally and yields each entry of "logEvents"
+    # together with the header fields seen so far (CloudWatch sends logGroup/logStream first),
+    # so only one log event plus one decoded chunk is held in memory at a time.
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer, pos, header = "", 0, {}
+
+    def fill():
+        nonlocal buffer, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer, pos = buffer[pos:] + chunk, 0
+        return True
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                raise ValueError("Truncated subscription payload")
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {pos} of subscription payload")
+        pos += 1
+
+    def read_value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end == len(buffer) and fill():
+                continue
+            pos = end
+            return value
+
+    expect("{")
+    while peek() != "}":
+        key = read_value()
+        expect(":")
+        if key == "logEvents":
+            expect("[")
+            while peek() != "]":
+                yield header, read_value()
+                if peek() == ",":
+                    pos += 1
+            pos += 1
+        else:
+            header[key] = read_value()
+        if peek() == ",":
+            pos += 1
+
+def encode_subscription_payload(log_group, log_stream, messages, start_timestamp=None):
+    # Builds a subscription event the same way CloudWatch Logs does, for local testing
+    start_timestamp = start_timestamp or int(time.time() * 1000)
+    payload = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "000000000000",
+        "logGroup": log_group,
+        "logStream": log_stream,
+        "subscriptionFilters": ["local-test"],
+        "logEvents": [
+            {"id": str(index), "timestamp": start_timestamp + index, "message": message}
+            for index, message in enumerate(messages)
+        ],
+    }
+    data = base64.b64encode(zlib.compress(json.dumps(payload).encode("utf-8"), wbits=zlib.MAX_WBITS | 16))
+    return {"awslogs": {"data": data.decode("ascii")}}
+
+def classify_severity(message):
+    match = SEVERITY_PATTERN.search(message)
+    severity = SEVERITY_LEVELS[match.group(1)] if match else SEVERITY_LEVELS["INFO"]
+    if "Traceback" in message or SERVER_ERROR_PATTERN.search(message):
+        severity = max(severity, SEVERITY_LEVELS["ERROR"])
+    return severity
+
+def record_event(key, log_event):
+    window = stream_windows.get(key)
+    if window is None:
+        window = stream_windows[key] = deque(maxlen=MAX_WINDOW_EVENTS)
+    message = log_event["message"]
+    window.append((log_event["timestamp"], classify_severity(message), message))
+
+    cutoff = log_event["timestamp"] - WINDOW_SECONDS * 1000
+    while window and window[0][0] < cutoff:
+        window.popleft()
+
+def evict_idle_windows():
+    # Log streams rotate (per task or per instance), so drop windows that have gone quiet
+    cutoff = int(time.time() * 1000) - WINDOW_SECONDS * 1000
+    for key in [key for key, window in stream_windows.items() if not window or window[-1][0] < cutoff]:
+        del stream_windows[key]
+
+    now = time.monotonic()
+    for key in [key for key, analysed_at in last_analysis.items() if now - analysed_at >= ANALYSIS_COOLDOWN_SECONDS]:
+        del last_analysis[key]
+
+def window_tripped(window):
+    if not window:
+        return False
+    severities = [severity for _, severity, _ in window]
+    if max(severities) >= SEVERITY_LEVELS[SEVERITY_THRESHOLD]:
+        return True
+    errors = sum(1 for severity in severities if severity >= SEVERITY_LEVELS["ERROR"])
+    return len(window) >= MIN_WINDOW_EVENTS and errors / len(window) >= ERROR_RATE_THRESHOLD
+
+def find_service(log_group):
+    for service in SERVICE_REGISTRY:
+        if log_group in service.get("log_groups", []):
+            return service
+    if log_group == LOG_GROUP:
+        return {
+            "name": log_group,
+            "instances": {"fastapi-instance": FASTAPI_INSTANCE_ID, "db-instance": DB_INSTANCE_ID},
+        }
+    # Unknown log group: still analyse and alert, but never send fix commands to unrelated hosts
+    return {"name": log_group, "instances": {}}
+
+def collect_tripped_targets(keys):
+    now = time.monotonic()
+    entries_by_service, keys_by_service, services = {}, {}, {}
+    for key in keys:
+        window = stream_windows.get(key)
+        if now - last_analysis.get(key, float("-inf")) < ANALYSIS_COOLDOWN_SECONDS or not window_tripped(window):
+            continue
+        service = find_service(key[0])
+        services[service["name"]] = service
+        entries_by_service.setdefault(service["name"], []).extend(window)
+        keys_by_service.setdefault(service["name"], []).append(key)
+
+    targets = []
+    for name, entries in entries_by_service.items():
+        log_text = "\n".join(message for _, _, message in sorted(entries, key=lambda entry: entry[0]))
+        targets.append({"service": services[name], "log_text": truncate_logs(log_text), "stream_keys": keys_by_service[name]})
+    return targets
+
+def mark_streams_analysed(batch):
+    # Only after a successful analysis: start afresh so the same lines are not re-analysed,
+    # and mute the streams for the cooldown. Failed or skipped batches stay tripped.
+    now = time.monotonic()
+    for target in batch:
+        for key in target["stream_keys"]:
+            window = stream_windows.get(key)
+            if window is not None:
+                window.clear()
+            last_analysis[key] = now
+
 def send_alert(subject, message):
     try:
         sns_client.publish(
@@ -130,15 +679,19 @@ def send_alert(subject, message):
 def parse_fix_and_prepare_command(llm_output):
     try:
         data = json.loads(llm_output)
-        fix = data.get("fix", {})
-        action = fix.get("action")
-        target = fix.get("target")
+        return prepare_fix_command(
+            data.get("fix", {}),
+            {"fastapi-instance": FASTAPI_INSTANCE_ID, "db-instance": DB_INSTANCE_ID}
+        )
+    except Exception as e:
+        print("Failed to parse LLM output:", e)
+        return None, None
 
-        if target == "fastapi-instance":
-            instance_id = FASTAPI_INSTANCE_ID
-        elif target == "db-instance":
-            instance_id = DB_INSTANCE_ID
-        else:
+def prepare_fix_command(fix, instances):
+    try:
+        action = fix.get("action")
+        instance_id = instances.get(fix.get("target"))
+        if not instance_id:
             return None, None
 
         if action == "restart_service":
@@ -154,7 +707,7 @@ def parse_fix_and_prepare_command(llm_output):
         else:
             return None, None
     except Exception as e:
-        print("Failed to parse LLM output:", e)
+        print("Failed to prepare fix command:", e)
         return None, None
 
 def send_ssm_command(instance_id, command):